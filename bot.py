@@ -1,17 +1,23 @@
 import logging
-import sqlite3
-import requests
+import aiosqlite
+import httpx
+import orjson
+import pybase64
 import time
 import os
 import asyncio
-import base64
 import random
 from io import BytesIO
 from dotenv import load_dotenv
-from collections import deque
+from collections import deque, OrderedDict
+from datetime import timedelta
+from contextlib import asynccontextmanager
+from itertools import islice
+from PIL import Image
 
 from telegram import Update, User
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -42,11 +48,20 @@ if not BOT_TOKEN:
 # LM Studio
 # ------------------------------------------------------------------------------
 LM_BASE = "http://localhost:1234/v1"
-LM_CHAT = f"{LM_BASE}/chat/completions"
+LM_CHAT = "/chat/completions"
 
 DEFAULT_MODEL = "llava"
 TOKEN_THRESHOLD = 12000
 
+# How often a streamed reply is pushed to Telegram (edits are rate limited).
+STREAM_EDIT_CHARS = 400
+STREAM_EDIT_INTERVAL = 0.7
+
+# Images larger than VISION_RESIZE_BYTES are downscaled to fit in
+# VISION_MAX_SIDE (typical vision encoder input) and re-encoded as JPEG.
+VISION_RESIZE_BYTES = 200_000
+VISION_MAX_SIDE = 672
+
 conversation_params = {
     "max_tokens": 700,
     "temperature": 0.4,
@@ -56,7 +71,13 @@ conversation_params = {
 # ------------------------------------------------------------------------------
 # Runtime state
 # ------------------------------------------------------------------------------
+# Pending text messages per user. Each queue is drained by a single worker
+# task that is started with it and exits, dropping the queue, after
+# USER_WORKER_IDLE seconds without new messages.
 USER_QUEUES = {}
+USER_QUEUE_MAX = 20
+USER_WORKER_IDLE = 60
+# Users whose worker is generating a reply right now.
 USER_PROCESSING = set()
 
 UNSUPPORTED_STICKER_MESSAGES = [
@@ -65,39 +86,84 @@ UNSUPPORTED_STICKER_MESSAGES = [
     "🎬 Looks cool! But I can’t read animated or video stickers."
 ]
 
+EMPTY_REPLY_MESSAGE = "🤔 I couldn’t come up with a reply. Please try again."
+
 # ------------------------------------------------------------------------------
 # Database
 # ------------------------------------------------------------------------------
 DB_FILE = "conversations.db"
 
-
-def init_db():
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        c = conn.cursor()
-
-        c.execute("""
+# Single shared aiosqlite connection, opened once in init_db(). It runs
+# queries on its own thread; writes are serialized through _DB_LOCK so one
+# coroutine's transaction never interleaves with another's statements.
+_CONN = None
+_DB_LOCK = asyncio.Lock()
+
+# Trimmed message history of recently used conversations, keyed by conversation
+# id, so a reply does not have to re-read the whole conversation from SQLite.
+# Each entry holds a deque of (role, content, length) and the running char sum.
+CID_HISTORY = OrderedDict()
+CID_HISTORY_MAX = 512
+
+# When each user was last written to the users table; upsert_user skips the
+# write if it happened less than LAST_SEEN_INTERVAL seconds ago.
+_LAST_SEEN = {}
+LAST_SEEN_INTERVAL = 60
+
+# user_settings rows by user id; kept in sync by the helpers that write them.
+_SETTINGS_CACHE = {}
+
+
+@asynccontextmanager
+async def transaction():
+    async with _DB_LOCK:
+        await _CONN.execute("BEGIN")
+        try:
+            yield _CONN
+            await _CONN.commit()
+        except BaseException:
+            # Also covers a failed COMMIT, which would otherwise leave the
+            # shared connection stuck inside an open transaction.
+            await _CONN.rollback()
+            raise
+
+
+async def init_db():
+    global _CONN
+    # sqlite3 keeps compiled statements per connection, keyed by SQL text, so
+    # the helpers below reuse them as long as their queries stay literal.
+    _CONN = await aiosqlite.connect(DB_FILE, isolation_level=None)
+    await _CONN.execute("PRAGMA journal_mode=WAL;")
+    # NORMAL is still crash-safe under WAL and skips the fsync on every commit.
+    await _CONN.execute("PRAGMA synchronous=NORMAL;")
+    await _CONN.execute("PRAGMA wal_autocheckpoint=1000;")
+    await _CONN.execute("PRAGMA temp_store=MEMORY;")
+    await _CONN.execute("PRAGMA cache_size=-20000;")
+    await _CONN.execute("PRAGMA cache_spill=OFF;")
+
+    async with transaction() as db:
+        await db.execute("""
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
             last_seen INTEGER
         )""")
 
-        c.execute("""
+        await db.execute("""
         CREATE TABLE IF NOT EXISTS user_settings (
             user_id INTEGER PRIMARY KEY,
             default_model TEXT,
             active_conversation_id INTEGER
         )""")
 
-        c.execute("""
+        await db.execute("""
         CREATE TABLE IF NOT EXISTS conversations (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
             model TEXT
         )""")
 
-        c.execute("""
+        await db.execute("""
         CREATE TABLE IF NOT EXISTS messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             conversation_id INTEGER,
@@ -106,132 +172,335 @@ def init_db():
             ts INTEGER
         )""")
 
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS ix_messages_cid_ts ON messages(conversation_id, ts)"
+        )
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS ix_conversations_user ON conversations(user_id)"
+        )
+
 
-def upsert_user(user: User):
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute("""
+async def close_db():
+    if _CONN is not None:
+        await _CONN.close()
+
+
+async def upsert_user(user: User):
+    now = int(time.time())
+    if now - _LAST_SEEN.get(user.id, 0) < LAST_SEEN_INTERVAL:
+        return
+
+    async with transaction() as db:
+        await db.execute("""
         INSERT INTO users VALUES (?, ?, ?)
         ON CONFLICT(user_id)
         DO UPDATE SET last_seen=excluded.last_seen
-        """, (user.id, user.username or "", int(time.time())))
+        """, (user.id, user.username or "", now))
 
-        conn.execute("""
+        await db.execute("""
         INSERT INTO user_settings VALUES (?, ?, ?)
         ON CONFLICT(user_id) DO NOTHING
         """, (user.id, DEFAULT_MODEL, None))
 
+    _LAST_SEEN[user.id] = now
 
-def get_settings(user_id):
-    with sqlite3.connect(DB_FILE) as conn:
-        row = conn.execute(
+
+async def get_settings(user_id):
+    settings = _SETTINGS_CACHE.get(user_id)
+    if settings is not None:
+        return settings
+
+    # Read under the lock so the row is never taken from the middle of another
+    # coroutine's transaction (e.g. a half-finished clear_user_history).
+    async with _DB_LOCK:
+        async with _CONN.execute(
             "SELECT default_model, active_conversation_id FROM user_settings WHERE user_id=?",
             (user_id,),
-        ).fetchone()
-    return {"model": row[0], "cid": row[1]}
+        ) as cur:
+            row = await cur.fetchone()
+    # A concurrent lookup may have cached (and since updated) the row while we
+    # were waiting; keep that entry rather than overwriting it.
+    return _SETTINGS_CACHE.setdefault(user_id, {"model": row[0], "cid": row[1]})
 
 
-def set_active_conversation(user_id, cid):
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute(
+async def set_active_conversation(user_id, cid):
+    async with _DB_LOCK:
+        await _CONN.execute(
             "UPDATE user_settings SET active_conversation_id=? WHERE user_id=?",
             (cid, user_id),
         )
 
+    settings = _SETTINGS_CACHE.get(user_id)
+    if settings is not None:
+        settings["cid"] = cid
+
 
-def create_conversation(user_id, model):
-    with sqlite3.connect(DB_FILE) as conn:
-        cur = conn.cursor()
-        cur.execute(
+async def create_conversation(user_id, model):
+    async with _DB_LOCK:
+        cur = await _CONN.execute(
             "INSERT INTO conversations (user_id, model) VALUES (?, ?)",
             (user_id, model),
         )
         return cur.lastrowid
 
 
-def append_message(cid, role, content):
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute(
+async def append_messages(cid, rows):
+    async with transaction() as db:
+        await db.executemany(
             "INSERT INTO messages VALUES (NULL, ?, ?, ?, ?)",
-            (cid, role, content, int(time.time())),
+            [(cid, role, content, ts) for role, content, ts in rows],
         )
 
+    history = CID_HISTORY.get(cid)
+    if history is not None:
+        for role, content, _ in rows:
+            push_history(history, role, content)
 
-def get_messages(cid):
-    with sqlite3.connect(DB_FILE) as conn:
-        rows = conn.execute(
-            "SELECT role, content FROM messages WHERE conversation_id=? ORDER BY ts",
+
+async def get_history(cid):
+    history = CID_HISTORY.get(cid)
+    if history is not None:
+        CID_HISTORY.move_to_end(cid)
+        return history
+
+    history = {"items": deque(), "chars": 0}
+    # Like get_settings, read under the lock: the result is cached, so it must
+    # not include rows from another coroutine's uncommitted transaction.
+    async with _DB_LOCK:
+        async with _CONN.execute(
+            "SELECT role, content FROM messages WHERE conversation_id=? ORDER BY ts, id",
             (cid,),
-        ).fetchall()
-    return [{"role": r[0], "content": r[1]} for r in rows]
+        ) as cur:
+            async for role, content in cur:
+                push_history(history, role, content)
 
+    CID_HISTORY[cid] = history
+    if len(CID_HISTORY) > CID_HISTORY_MAX:
+        CID_HISTORY.popitem(last=False)
+    return history
 
-def clear_user_history(user_id):
-    with sqlite3.connect(DB_FILE) as conn:
-        c = conn.cursor()
-        c.execute("SELECT id FROM conversations WHERE user_id=?", (user_id,))
-        ids = [r[0] for r in c.fetchall()]
 
-        for cid in ids:
-            conn.execute("DELETE FROM messages WHERE conversation_id=?", (cid,))
-        conn.execute("DELETE FROM conversations WHERE user_id=?", (user_id,))
-        conn.execute(
+async def clear_user_history(user_id):
+    async with transaction() as db:
+        async with db.execute(
+            "SELECT active_conversation_id FROM user_settings WHERE user_id=?",
+            (user_id,),
+        ) as cur:
+            row = await cur.fetchone()
+
+        await db.execute(
+            "DELETE FROM messages WHERE conversation_id IN "
+            "(SELECT id FROM conversations WHERE user_id=?)",
+            (user_id,),
+        )
+        await db.execute("DELETE FROM conversations WHERE user_id=?", (user_id,))
+        await db.execute(
             "UPDATE user_settings SET active_conversation_id=NULL WHERE user_id=?",
             (user_id,),
         )
 
+    # Only the active conversation is ever loaded into the cache; ids are
+    # never reused, so nothing else can be served stale.
+    if row:
+        CID_HISTORY.pop(row[0], None)
+
+    settings = _SETTINGS_CACHE.get(user_id)
+    if settings is not None:
+        settings["cid"] = None
+
 # ------------------------------------------------------------------------------
 # Utils
 # ------------------------------------------------------------------------------
-def trim_messages(messages, max_chars=TOKEN_THRESHOLD):
-    total = 0
-    result = []
-    for m in reversed(messages):
-        total += len(m["content"])
-        if total > max_chars:
-            break
-        result.append(m)
-    return list(reversed(result))
+def push_history(history, role, content, max_chars=TOKEN_THRESHOLD):
+    size = len(content)
+    history["items"].append((role, content, size))
+    history["chars"] += size
+
+    items = history["items"]
+    while history["chars"] > max_chars:
+        history["chars"] -= items.popleft()[2]
+
+
+def trim_messages(history, text, max_chars=TOKEN_THRESHOLD):
+    items = history["items"]
+    total = history["chars"] + len(text)
+
+    skip = 0
+    while total > max_chars and skip < len(items):
+        total -= items[skip][2]
+        skip += 1
+
+    messages = [
+        {"role": role, "content": content}
+        for role, content, _ in islice(items, skip, None)
+    ]
+    messages.append({"role": "user", "content": text})
+    return messages
+
+
+def has_markdown(text):
+    # Legacy Markdown rejects the whole message on any unpaired entity marker,
+    # so only send parse_mode when every marker is paired and one is present.
+    counts = [text.count(ch) for ch in "*_`"]
+    return any(counts) and all(n % 2 == 0 for n in counts)
 
 
-def image_to_b64(data: bytes) -> str:
-    return base64.b64encode(data).decode()
+def shrink_image(raw):
+    if len(raw) <= VISION_RESIZE_BYTES:
+        return raw
+
+    try:
+        with Image.open(BytesIO(raw)) as im:
+            im.thumbnail((VISION_MAX_SIDE, VISION_MAX_SIDE))
+            if "A" in im.getbands() or "transparency" in im.info:
+                # Stickers are transparent; flatten onto white so dark line
+                # art does not vanish into black transparent pixels.
+                rgba = im.convert("RGBA")
+                rgb = Image.new("RGB", im.size, "white")
+                rgb.paste(rgba, mask=rgba.getchannel("A"))
+            else:
+                rgb = im.convert("RGB")
+            buf = BytesIO()
+            rgb.save(buf, "JPEG", quality=85)
+    except OSError as e:
+        logger.warning("Sending image as is, could not re-encode it: %s", e)
+        return raw
+    return buf.getbuffer()
+
+
+def image_to_b64(data) -> bytes:
+    return pybase64.b64encode(data)
 
 # ------------------------------------------------------------------------------
 # LM Studio
 # ------------------------------------------------------------------------------
+# Shared keep-alive client, opened in post_init() and closed in post_shutdown().
+# Every request reuses its connection pool to LM Studio.
+_CLIENT = None
+
+
+async def stream_lm(body, timeout):
+    async with _CLIENT.stream(
+        "POST",
+        LM_CHAT,
+        content=body,
+        timeout=timeout,
+    ) as r:
+        r.raise_for_status()
+        async for line in r.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            obj = orjson.loads(data)
+            if "error" in obj:
+                # Stop here; stream_reply shows whatever arrived so far, or
+                # the empty-reply notice.
+                logger.error("LM Studio stream error: %s", obj["error"])
+                break
+            # Usage and keep-alive frames come with an empty choices list.
+            choices = obj.get("choices") or []
+            if not choices:
+                continue
+            delta = (choices[0].get("delta") or {}).get("content")
+            if delta:
+                yield delta
+
+
 def call_lm_chat(messages, model):
     payload = {
         "model": model,
         "messages": messages,
         **conversation_params,
+        "stream": True,
     }
-    r = requests.post(LM_CHAT, json=payload, timeout=180)
-    r.raise_for_status()
-    return r.json()
+    return stream_lm(orjson.dumps(payload), timeout=180)
 
 
 def call_lm_vision(image_b64, prompt, model):
-    payload = {
-        "model": model,
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_b64}"
-                        },
-                    },
-                ],
-            }
-        ],
-        "max_tokens": 700,
-    }
-    r = requests.post(LM_CHAT, json=payload, timeout=240)
-    r.raise_for_status()
-    return r.json()
+    # Assemble the body by hand so the base64 image is copied into it once
+    # instead of being decoded to str and re-escaped by the JSON encoder.
+    body = b"".join((
+        b'{"model":', orjson.dumps(model),
+        b',"messages":[{"role":"user","content":[{"type":"text","text":',
+        orjson.dumps(prompt),
+        b'},{"type":"image_url","image_url":{"url":"data:image/jpeg;base64,',
+        image_b64,
+        b'"}}]}],"max_tokens":700,"stream":true}',
+    ))
+    return stream_lm(body, timeout=240)
+
+
+def retry_after_seconds(e: RetryAfter):
+    delay = e.retry_after
+    if isinstance(delay, timedelta):
+        return delay.total_seconds()
+    return delay
+
+
+async def final_edit(sent, text, not_before, parse_mode=None):
+    # The last edit carries the complete reply, so wait out flood control
+    # (once) instead of leaving the user with a truncated message.
+    delay = not_before - time.monotonic()
+    if delay > 0:
+        await asyncio.sleep(delay)
+    for attempt in range(2):
+        try:
+            await sent.edit_text(text, parse_mode=parse_mode)
+            return
+        except RetryAfter as e:
+            if attempt:
+                logger.warning("Giving up on final edit: %s", e)
+                return
+            await asyncio.sleep(retry_after_seconds(e))
+        except BadRequest as e:
+            # The message already shows this text; nothing left to do.
+            if "message is not modified" in str(e).lower():
+                return
+            raise
+
+
+async def stream_reply(sent, chunks, parse_mode=None):
+    answer = ""
+    shown = ""
+    last_edit = time.monotonic()
+    # Earliest time Telegram will accept another edit after a RetryAfter.
+    next_edit = 0.0
+
+    async for chunk in chunks:
+        answer += chunk
+        now = time.monotonic()
+        if (
+            len(answer) - len(shown) >= STREAM_EDIT_CHARS
+            or now - last_edit >= STREAM_EDIT_INTERVAL
+        ) and now >= next_edit and answer.strip() not in ("", shown.strip()):
+            try:
+                await sent.edit_text(answer)
+                shown = answer
+            except RetryAfter as e:
+                next_edit = time.monotonic() + retry_after_seconds(e)
+                logger.warning("Pausing intermediate edits: %s", e)
+            except TelegramError as e:
+                logger.warning("Skipping intermediate edit: %s", e)
+            last_edit = time.monotonic()
+
+    if not answer.strip():
+        await final_edit(sent, EMPTY_REPLY_MESSAGE, next_edit)
+        return ""
+
+    if parse_mode and has_markdown(answer):
+        try:
+            await final_edit(sent, answer, next_edit, parse_mode=parse_mode)
+            return answer
+        except BadRequest:
+            # Markup Telegram still refuses (e.g. a stray "["); keep plain text.
+            pass
+
+    # Telegram trims trailing whitespace, so only edit if visible text changed.
+    if answer.strip() != shown.strip():
+        await final_edit(sent, answer, next_edit)
+    return answer
 
 # ------------------------------------------------------------------------------
 # Commands
@@ -251,7 +520,7 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     if uid in USER_PROCESSING:
-        q = len(USER_QUEUES.get(uid, []))
+        q = USER_QUEUES[uid].qsize()
         await update.message.reply_text(
             f"🤖 I’m thinking right now.\n"
             f"📨 Messages in queue: {q}"
@@ -261,7 +530,7 @@ async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def clear_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    clear_user_history(update.effective_user.id)
+    await clear_user_history(update.effective_user.id)
     await update.message.reply_text("🧹 History cleared.")
 
 # ------------------------------------------------------------------------------
@@ -271,65 +540,87 @@ async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     uid = user.id
 
-    upsert_user(user)
+    await upsert_user(user)
 
-    if uid not in USER_QUEUES:
-        USER_QUEUES[uid] = deque()
+    queue = USER_QUEUES.get(uid)
+    if queue is None:
+        queue = USER_QUEUES[uid] = asyncio.Queue(maxsize=USER_QUEUE_MAX)
+        asyncio.create_task(user_worker(uid, queue, context))
 
-    USER_QUEUES[uid].append({
+    waiting = uid in USER_PROCESSING or not queue.empty()
+    dropped = queue.full()
+    if dropped:
+        queue.get_nowait()
+    queue.put_nowait({
         "text": update.message.text,
         "message_id": update.message.message_id,
         "chat_id": update.effective_chat.id
     })
 
-    if uid in USER_PROCESSING:
-        await update.message.reply_text(
+    if waiting:
+        notice = (
             "⏳ I’m already answering a previous question.\n"
             "I’ll respond to this one right after."
         )
-        return
-
-    asyncio.create_task(process_user_queue(uid, context))
-
+        if dropped:
+            notice += "\n⚠️ Too many messages in the queue — the oldest one was dropped."
+        await update.message.reply_text(notice)
 
-async def process_user_queue(user_id, context: ContextTypes.DEFAULT_TYPE):
-    USER_PROCESSING.add(user_id)
 
+async def user_worker(user_id, queue, context: ContextTypes.DEFAULT_TYPE):
     try:
-        while USER_QUEUES[user_id]:
-            item = USER_QUEUES[user_id].popleft()
-
-            text = item["text"]
-            reply_to = item["message_id"]
-            chat_id = item["chat_id"]
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), USER_WORKER_IDLE)
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    return
+                continue
+
+            USER_PROCESSING.add(user_id)
+            try:
+                await answer_message(user_id, item, context)
+            except Exception:
+                logger.exception("Failed to answer message from user %s", user_id)
+            finally:
+                USER_PROCESSING.discard(user_id)
+    finally:
+        USER_QUEUES.pop(user_id, None)
 
-            s = get_settings(user_id)
-            cid = s["cid"]
-            if not cid:
-                cid = create_conversation(user_id, s["model"])
-                set_active_conversation(user_id, cid)
 
-            append_message(cid, "user", text)
+async def answer_message(user_id, item, context: ContextTypes.DEFAULT_TYPE):
+    text = item["text"]
+    reply_to = item["message_id"]
+    chat_id = item["chat_id"]
 
-            sent = await context.bot.send_message(
-                chat_id=chat_id,
-                text="🤖 Thinking...",
-                reply_to_message_id=reply_to
-            )
+    s = await get_settings(user_id)
+    cid = s["cid"]
+    if not cid:
+        cid = await create_conversation(user_id, s["model"])
+        await set_active_conversation(user_id, cid)
 
-            msgs = trim_messages(get_messages(cid))
+    user_ts = int(time.time())
 
-            data = await asyncio.to_thread(
-                call_lm_chat, msgs, s["model"]
-            )
-            answer = data["choices"][0]["message"]["content"]
+    sent = await context.bot.send_message(
+        chat_id=chat_id,
+        text="🤖 Thinking...",
+        reply_to_message_id=reply_to
+    )
 
-            append_message(cid, "assistant", answer)
+    msgs = trim_messages(await get_history(cid), text)
 
-            await sent.edit_text(answer, parse_mode=ParseMode.MARKDOWN)
+    answer = await stream_reply(
+        sent, call_lm_chat(msgs, s["model"]), ParseMode.MARKDOWN
+    )
+    if not answer:
+        # Nothing to remember; an empty assistant turn would be fed back to
+        # the model on every later request.
+        return
 
-    finally:
-        USER_PROCESSING.discard(user_id)
+    await append_messages(cid, [
+        ("user", text, user_ts),
+        ("assistant", answer, int(time.time())),
+    ])
 
 # ------------------------------------------------------------------------------
 # Stickers (reply)
@@ -346,10 +637,10 @@ async def sticker_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     file = await sticker.get_file()
-    bio = BytesIO()
-    await file.download_to_memory(out=bio)
+    raw = await file.download_as_bytearray()
+    raw = await asyncio.to_thread(shrink_image, raw)
 
-    image_b64 = image_to_b64(bio.getvalue())
+    image_b64 = image_to_b64(raw)
     prompt = (
         "I sent a sticker as a reply to your message. You can react to it. "
         "Respond while taking into account the context of the attached sticker image, "
@@ -357,7 +648,7 @@ async def sticker_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "shown in the sticker image."
     )
 
-    s = get_settings(update.effective_user.id)
+    s = await get_settings(update.effective_user.id)
 
     sent = await context.bot.send_message(
         chat_id=update.effective_chat.id,
@@ -365,12 +656,7 @@ async def sticker_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_to_message_id=update.message.message_id
     )
 
-    data = await asyncio.to_thread(
-        call_lm_vision, image_b64, prompt, s["model"]
-    )
-    answer = data["choices"][0]["message"]["content"]
-
-    await sent.edit_text(answer)
+    await stream_reply(sent, call_lm_vision(image_b64, prompt, s["model"]))
 
 # ------------------------------------------------------------------------------
 # Images (reply)
@@ -378,14 +664,13 @@ async def sticker_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def image_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     photo = update.message.photo[-1]
     file = await photo.get_file()
+    raw = await file.download_as_bytearray()
+    raw = await asyncio.to_thread(shrink_image, raw)
 
-    bio = BytesIO()
-    await file.download_to_memory(out=bio)
-
-    image_b64 = image_to_b64(bio.getvalue())
+    image_b64 = image_to_b64(raw)
     prompt = update.message.caption or "Describe the image"
 
-    s = get_settings(update.effective_user.id)
+    s = await get_settings(update.effective_user.id)
 
     sent = await context.bot.send_message(
         chat_id=update.effective_chat.id,
@@ -393,12 +678,7 @@ async def image_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_to_message_id=update.message.message_id
     )
 
-    data = await asyncio.to_thread(
-        call_lm_vision, image_b64, prompt, s["model"]
-    )
-    answer = data["choices"][0]["message"]["content"]
-
-    await sent.edit_text(answer)
+    await stream_reply(sent, call_lm_vision(image_b64, prompt, s["model"]))
 
 # ------------------------------------------------------------------------------
 # Errors
@@ -409,9 +689,24 @@ async def error_handler(update, context):
 # ------------------------------------------------------------------------------
 # Main
 # ------------------------------------------------------------------------------
-def main():
-    init_db()
+async def post_init(app: Application):
+    global _CLIENT
+    await init_db()
+    _CLIENT = httpx.AsyncClient(
+        base_url=LM_BASE,
+        headers={"Content-Type": "application/json"},
+        timeout=240,
+        limits=httpx.Limits(max_keepalive_connections=32),
+    )
+
 
+async def post_shutdown(app: Application):
+    if _CLIENT is not None:
+        await _CLIENT.aclose()
+    await close_db()
+
+
+def main():
     request = HTTPXRequest(
         read_timeout=120,
         write_timeout=120,
@@ -422,6 +717,8 @@ def main():
         Application.builder()
         .token(BOT_TOKEN)
         .request(request)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
@@ -2,5 +2,9 @@
 title Install
 pip install python-dotenv
 pip install python_telegram_bot
-pip install requests
+pip install httpx
+pip install pybase64
+pip install aiosqlite
+pip install orjson
+pip install pillow
 pause